@@ -1,16 +1,53 @@
+import functools
+import os
+import warnings
+
 import torch
+import torch.nn.functional as F
 
 from typing import final
 
 from lightning import Callback
-from sentence_transformers.util import cos_sim
 
 REDUCTIONS: final = frozenset(["mean", "average", "avg", "sum", "add", "none"])
 
+# Checking for NaNs/Infs forces a device sync, only do it when debugging (RSDIX_DEBUG_NANS=1)
+_DEBUG_NANS: final = os.environ.get("RSDIX_DEBUG_NANS", "0") == "1"
+
+
+def _lazy_compile(fn=None, **compile_kwargs):
+    """
+    Compile fn with torch.compile on its first call, falling back to eager execution whenever compilation fails:
+    either Dynamo refusing the platform (e.g. Windows) or Inductor/Triton failing on the first run (e.g. GPUs older
+    than sm70, CPU builds without OpenMP). Importing this module therefore never compiles anything.
+    """
+    if fn is None:
+        return functools.partial(_lazy_compile, **compile_kwargs)
+
+    compiled = None
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        nonlocal compiled
+
+        if compiled is not None:
+            return compiled(*args, **kwargs)
+
+        try:
+            compiled = torch.compile(fn, **compile_kwargs)
+            return compiled(*args, **kwargs)
+        except Exception as e:
+            warnings.warn(f"Could not compile {fn.__name__}, falling back to eager execution: {e}")
+            compiled = fn
+            return fn(*args, **kwargs)
+
+    return wrapper
+
 
 # Source: https://github.com/facebookresearch/OTTER/blob/main/models/model_util.py
 def _has_nan_or_inf(x):
-    return torch.isnan(x).any() or torch.isinf(x).any()
+    # a single reduction (and a single device sync) instead of two
+    return not torch.isfinite(x).all()
 
 
 # Source: https://github.com/facebookresearch/OTTER/blob/main/models/model_util.py
@@ -21,33 +58,59 @@ def sinkhorn(cost_mat, eps=0.05, niter=5, r_prob=None, c_prob=None):
     r_prob: s1, s2, ..., sn, M
     c_prob: s1, s2, ..., sn, N
     """
+    if _DEBUG_NANS:
+        # the NaN/Inf checks are data-dependent branches, which cannot be captured in a full graph
+        return _sinkhorn(cost_mat, eps, niter, r_prob, c_prob)
 
-    q = torch.exp(-cost_mat / eps)
-    q = q / q.sum(dim=[-2, -1], keepdim=True)
-    m, n = q.shape[-2], q.shape[-1]
+    return _compiled_sinkhorn(cost_mat, eps, niter, r_prob, c_prob)
+
+
+def _sinkhorn(cost_mat, eps, niter, r_prob, c_prob):
+    # Shift each row of the cost by its minimum, then each column by its minimum: the row shifts are absorbed by
+    # u and the column shifts by v, so the plan does not change. Afterwards the kernel lies in (0, 1] with an entry
+    # equal to 1 in every row and every column, hence it cannot overflow for small eps and neither k @ v nor
+    # k^T @ u can underflow to zero
+    cost_mat = cost_mat - cost_mat.amin(dim=-1, keepdim=True)
+    cost_mat = cost_mat - cost_mat.amin(dim=-2, keepdim=True)
+    k = torch.exp(-cost_mat / eps)
+    m, n = k.shape[-2], k.shape[-1]
 
     if r_prob is not None:
         # s1, ..., sn, M -> s1, ..., sn, M, 1
         r_prob = (r_prob / r_prob.sum(dim=-1, keepdim=True)).unsqueeze(-1)
-        assert not _has_nan_or_inf(r_prob)
+        if _DEBUG_NANS:
+            assert not _has_nan_or_inf(r_prob)
     else:
         r_prob = 1 / m
 
     if c_prob is not None:
-        # s1, ..., sn, N -> s1, ..., sn, 1, N
-        c_prob = (c_prob / c_prob.sum(dim=-1, keepdim=True)).unsqueeze(-2)
-        assert not _has_nan_or_inf(c_prob)
+        # s1, ..., sn, N -> s1, ..., sn, N, 1
+        c_prob = (c_prob / c_prob.sum(dim=-1, keepdim=True)).unsqueeze(-1)
+        if _DEBUG_NANS:
+            assert not _has_nan_or_inf(c_prob)
     else:
         c_prob = 1 / n
 
+    # Only the scaling vectors are updated, the kernel is never rewritten
+    # s1, ..., sn, M, 1 and s1, ..., sn, N, 1
+    u = torch.ones_like(k[..., :1])
+    v = torch.ones_like(k[..., :1, :]).transpose(-2, -1)
+
     for _ in range(niter):
         # normalize each row: total weight per row must be r_prob
-        q /= q.sum(dim=-1, keepdim=True)
-        q *= r_prob
+        u = r_prob / (k @ v)
         # normalize each column: total weight per column must be c_prob
-        q /= q.sum(dim=-2, keepdim=True)
-        q *= c_prob
-    return q / q.sum(dim=1, keepdim=True)
+        v = c_prob / (k.transpose(-2, -1) @ u)
+
+    return u * k * v.transpose(-2, -1)
+
+
+# Within a training run the cost matrix shape (batch size x batch size) and niter are fixed: compile a full graph
+# specialized on them (Dynamo guards recompile per shape, dtype and device, i.e. at most once more for the last
+# batch), so that the loop is unrolled and Inductor picks kernels for the known sizes.
+# CUDA graphs ("reduce-overhead") are not used: the images and text plans come from two consecutive calls
+# and a graph replay would overwrite the output of the previous one
+_compiled_sinkhorn = _lazy_compile(_sinkhorn, fullgraph=True, dynamic=False)
 
 
 @torch.no_grad()
@@ -65,11 +128,36 @@ def compute_similarities(i_emb, t_emb):
         sim_it (torch.Tensor): Similarities between image and text embeddings.
         sim_ti (torch.Tensor): Similarities between text and image embeddings.
     """
-    sim_ii, sim_tt = torch.matmul(i_emb, i_emb.t()), torch.matmul(t_emb, t_emb.t())
-    sim_it, sim_ti = torch.matmul(i_emb, t_emb.t()), torch.matmul(t_emb, i_emb.t())
+    # A single GEMM over the stacked embeddings yields all four similarity blocks
+    x = torch.cat([i_emb, t_emb], dim=0)
+    sim = torch.matmul(x, x.t())
+    n = i_emb.size(0)
+
+    sim_ii, sim_tt = sim[:n, :n], sim[n:, n:]
+    sim_it, sim_ti = sim[:n, n:], sim[n:, :n]
     return sim_ii, sim_tt, sim_it, sim_ti
 
 
+@_lazy_compile(dynamic=True)
+def _sim_block(i_emb, t_emb, ii_coeff, tt_coeff, remove_diag):
+    """
+    Compute the images and text optimal transport cost matrices from the embeddings in a single compiled graph:
+    the stacked similarity matmul, followed by one fused elementwise kernel for the diagonal removal, the
+    coefficients and the negation.
+
+    Returns:
+        images_cost_mat, text_cost_mat (torch.Tensor)
+    """
+    sim_ii, sim_tt, sim_it, sim_ti = compute_similarities(i_emb, t_emb)
+
+    # Generated within the graph, the diagonal is never materialized
+    diag = torch.eye(sim_ii.shape[-1], device=sim_ii.device, dtype=sim_ii.dtype) * (remove_diag * 1e2)
+    self_sim = ii_coeff * (sim_ii - diag) + tt_coeff * (sim_tt - diag)
+
+    # Only the cost matrices are returned, so that the similarity blocks are not written out as graph outputs
+    return -(self_sim + sim_it), -(self_sim + sim_ti)
+
+
 @torch.no_grad()
 def compute_teacher_targets(teacher_images_embs, teacher_text_embs, ii_coeff, tt_coeff, sinkhorn_lambda, sinkhorn_iter,
                             remove_diag, sigmoid_target: bool = False):
@@ -89,37 +177,52 @@ def compute_teacher_targets(teacher_images_embs, teacher_text_embs, ii_coeff, tt
         images_target_prob (torch.Tensor): Target probabilities for images.
         text_target_prob (torch.Tensor): Target probabilities for text.
     """
-    sim_ii, sim_tt, sim_it, sim_ti = compute_similarities(teacher_images_embs, teacher_text_embs)
-
-    diag = (torch.eye(*sim_ii.shape) * remove_diag * 1e2).to(teacher_images_embs.device)
-    sim_ii = (sim_ii - diag) * ii_coeff
-    sim_tt = (sim_tt - diag) * tt_coeff
-
-    # Optimal transport
-    # Perform sinkhorn based on the cost matrix, and then row-normalize
-    # to get target probability.
-    images_cost_mat = - (sim_ii + sim_tt + sim_it)
-    text_cost_mat = - (sim_ii + sim_tt + sim_ti)
+    # Sinkhorn divides the costs by sinkhorn_lambda, amplifying any rounding of the similarities: keep the
+    # similarity GEMM in full precision (TF32 tensor cores once enable_matmul_precision has been called)
+    # even when the trainer runs in mixed precision
+    with torch.autocast(device_type="cuda" if teacher_images_embs.is_cuda else "cpu", enabled=False):
+        teacher_images_embs, teacher_text_embs = teacher_images_embs.float(), teacher_text_embs.float()
+
+        if ii_coeff == 0 and tt_coeff == 0:
+            # The self-similarities (and the diagonal) do not contribute to the costs, skip them
+            sim_it = torch.matmul(teacher_images_embs, teacher_text_embs.t())
+            images_cost_mat, text_cost_mat = -sim_it, -sim_it.t()
+        else:
+            # Optimal transport
+            # Perform sinkhorn based on the cost matrix, and then row-normalize
+            # to get target probability.
+            images_cost_mat, text_cost_mat = _sim_block(teacher_images_embs, teacher_text_embs, ii_coeff, tt_coeff,
+                                                        remove_diag)
+
+    if sinkhorn_iter == 0:
+        # Without iterations the row-normalized kernel is exactly a softmax over the rows
+        images_target_prob = torch.softmax(-images_cost_mat / sinkhorn_lambda, dim=-1)
+        text_target_prob = torch.softmax(-text_cost_mat / sinkhorn_lambda, dim=-1)
+    else:
+        images_target_prob = sinkhorn(images_cost_mat, sinkhorn_lambda, sinkhorn_iter)
+        text_target_prob = sinkhorn(text_cost_mat, sinkhorn_lambda, sinkhorn_iter)
 
-    images_target_prob = sinkhorn(images_cost_mat, sinkhorn_lambda, sinkhorn_iter)
-    text_target_prob = sinkhorn(text_cost_mat, sinkhorn_lambda, sinkhorn_iter)
+        images_target_prob /= images_target_prob.sum(dim=-1, keepdim=True)
+        text_target_prob /= text_target_prob.sum(dim=-1, keepdim=True)
 
     if sigmoid_target:
         # Bring between -1 and 1 to match the sigmoid target
         #images_target_prob = images_target_prob.sigmoid()
         #text_target_prob = text_target_prob.sigmoid()
         # TODO: check if pre-normalizing (in such a way that rows sum to 1) is necessary or this sigmoid thing is fine
-        images_target_prob /= images_target_prob.sum(dim=1, keepdim=True)
-        text_target_prob /= text_target_prob.sum(dim=1, keepdim=True)
         images_target_prob = images_target_prob * 2 - 1
         text_target_prob = text_target_prob * 2 - 1
-    else:
-        images_target_prob /= images_target_prob.sum(dim=1, keepdim=True)
-        text_target_prob /= text_target_prob.sum(dim=1, keepdim=True)
 
     return images_target_prob, text_target_prob
 
 
+def _cos(a, b):
+    """
+    Compute the cosine similarity between already L2-normalized a and b.
+    """
+    return torch.matmul(a, b.t())
+
+
 @torch.no_grad()
 def compute_st_similarities(clip_image_embeddings, clip_text_embeddings, st_embeddings):
     """
@@ -136,14 +239,34 @@ def compute_st_similarities(clip_image_embeddings, clip_text_embeddings, st_embe
         text_text_similarities_clip (torch.Tensor): Similarities between CLIP text embeddings.
         text_text_similarities_st (torch.Tensor): Similarities between Sentence-BERT text embeddings.
     """
-    image_image_similarities = cos_sim(clip_image_embeddings, clip_image_embeddings)
-    image_text_similarities = cos_sim(clip_image_embeddings, clip_text_embeddings)
-    text_text_similarities_clip = cos_sim(clip_text_embeddings, clip_text_embeddings)
-    text_text_similarities_st = cos_sim(st_embeddings, st_embeddings)
+    # Normalize each input exactly once and reuse it across all the similarities
+    image_embeddings = F.normalize(clip_image_embeddings, dim=-1)
+    text_embeddings = F.normalize(clip_text_embeddings, dim=-1)
+    # Move the (batch size x embedding dim) Sentence-BERT embeddings rather than their (batch size x batch size)
+    # similarities, which are then computed on the same device as the CLIP ones
+    st_embeddings = F.normalize(torch.as_tensor(st_embeddings).to(clip_image_embeddings.device), dim=-1)
+
+    image_image_similarities = _cos(image_embeddings, image_embeddings)
+    image_text_similarities = _cos(image_embeddings, text_embeddings)
+    text_text_similarities_clip = _cos(text_embeddings, text_embeddings)
+    text_text_similarities_st = _cos(st_embeddings, st_embeddings)
 
     return image_image_similarities, image_text_similarities, text_text_similarities_clip, text_text_similarities_st
 
 
+# CUDA graphs ("reduce-overhead") are not used: their output buffers are overwritten on the next call,
+# while the returned MSE is kept around by the logger
+@_lazy_compile
+def _mse_terms(image_image_similarities, image_text_similarities, text_text_similarities_clip,
+               text_text_similarities_st):
+    """
+    Compute the three MSE terms against the Sentence-BERT similarities in a single fused graph.
+    """
+    return torch.stack([((image_image_similarities - text_text_similarities_st) ** 2).mean(),
+                        ((image_text_similarities - text_text_similarities_st) ** 2).mean(),
+                        ((text_text_similarities_clip - text_text_similarities_st) ** 2).mean()])
+
+
 @torch.no_grad()
 def compute_mse_similarities(image_image_similarities: torch.Tensor,
                              image_text_similarities: torch.Tensor,
@@ -169,16 +292,13 @@ def compute_mse_similarities(image_image_similarities: torch.Tensor,
     if reduction == "average":
         reduction = "mean"
 
-    mse_loss = torch.nn.MSELoss()
-    ii_mse = mse_loss(image_image_similarities, text_text_similarities_st)
-    it_mse = mse_loss(image_text_similarities, text_text_similarities_st)
-    tt_mse = mse_loss(text_text_similarities_clip, text_text_similarities_st)
-    mse_tensor = torch.stack([ii_mse, it_mse, tt_mse])
+    mse_tensor = _mse_terms(image_image_similarities, image_text_similarities, text_text_similarities_clip,
+                            text_text_similarities_st)
 
     if reduction == "mean" or reduction == "average" or reduction == "avg":
         return torch.mean(mse_tensor)
     if reduction == "sum" or reduction == "add":
-        return torch.mean(mse_tensor)
+        return torch.sum(mse_tensor)
     else:
         return mse_tensor
 
@@ -206,6 +326,25 @@ def compute_mse(clip_image_embeddings, clip_text_embeddings, st_embeddings, devi
     return compute_mse_similarities(ii_sim, it_sim, tt_sim_clip, tt_sim_st)
 
 
+@functools.lru_cache(maxsize=None)
+def _ground_truth(n, device):
+    """
+    Get the (cached) contrastive ground truth, i.e. the indices of the diagonal, for a batch of size n.
+    """
+    return torch.arange(n, device=device)
+
+
+@_lazy_compile(fullgraph=True)
+def _count_correct(logits, ground_truth):
+    """
+    Count the correct image and text predictions, reading the logits once in a single compiled graph.
+    """
+    a = logits.argmax(1)
+    b = logits.argmax(0)
+    return ((a == ground_truth).int() + (b == ground_truth).int()).sum()
+
+
+@torch.no_grad()
 def compute_accuracy(images_logits: torch.Tensor, batch_size: int):
     """
     Compute accuracy based on CLIP image-text similarity logits.
@@ -217,17 +356,32 @@ def compute_accuracy(images_logits: torch.Tensor, batch_size: int):
     Returns:
         accuracy (float): Accuracy based on the logits.
     """
-    ground_truth = torch.arange(len(images_logits)).to(images_logits.device)
-
-    acc_i = (torch.argmax(images_logits, 1) == ground_truth).sum()
-    acc_t = (torch.argmax(images_logits, 0) == ground_truth).sum()
+    ground_truth = _ground_truth(len(images_logits), images_logits.device)
+    correct = _count_correct(images_logits, ground_truth)
 
-    return (acc_i + acc_t) / 2 / batch_size
+    return correct / 2 / batch_size
 
 
 class MoveEmaCallback(Callback):
     def on_train_start(self, trainer, pl_module):
-        ema_params = pl_module.ema_model.shadow_params
+        shadow_params = pl_module.ema_model.shadow_params
+        device = pl_module.device
+
+        # Move the shadow parameters with one large copy per (dtype, device) instead of one small copy per parameter
+        indices_by_group = {}
+        for idx, p in enumerate(shadow_params):
+            if p.device != device:
+                indices_by_group.setdefault((p.dtype, p.device), []).append(idx)
+
+        for (dtype, src_device), indices in indices_by_group.items():
+            numels = [shadow_params[idx].numel() for idx in indices]
+            pin_memory = device.type == "cuda" and src_device.type == "cpu"
+
+            # Flatten straight into the (pinned) staging buffer, so that the parameters are copied on host only once
+            flat = torch.empty(sum(numels), dtype=dtype, device=src_device, pin_memory=pin_memory)
+            torch.cat([shadow_params[idx].reshape(-1) for idx in indices], out=flat)
+
+            flat = flat.to(device, non_blocking=pin_memory)
 
-        for idx, p in enumerate(ema_params):
-            pl_module.ema_model.shadow_params[idx] = pl_module.ema_model.shadow_params[idx].to(pl_module.device)
+            for idx, view in zip(indices, flat.split(numels)):
+                shadow_params[idx] = view.view_as(shadow_params[idx])
@@ -1,7 +1,7 @@
-import json
 import os
 from typing import Tuple
 
+import orjson
 import torch.cuda
 import xmltodict
 
@@ -66,8 +66,8 @@ def s2lcd_to_json(annotations_file: str, json_file_name: str = "dataset_s2lcd"):
 
     # get annotations_file directory
     data_dir = os.path.dirname(annotations_file)
-    with open(f"{data_dir}/{json_file_name}.json", "w") as f:
-        json.dump(images, f, indent=4)
+    with open(f"{data_dir}/{json_file_name}.json", "wb") as f:
+        f.write(orjson.dumps(images, option=orjson.OPT_INDENT_2))
 
 
 def separate_rsicd_test_images(annotations_file: str, test_output_file: str = "dataset_rsicd_test.json"):
@@ -79,9 +79,9 @@ def separate_rsicd_test_images(annotations_file: str, test_output_file: str = "d
         test_output_file (str): Name of the output JSON file for test images.
     """
     data = []
-    with open(annotations_file) as json_file:
+    with open(annotations_file, "rb") as json_file:
         for line in json_file:
-            data.append(json.loads(line))
+            data.append(orjson.loads(line))
     test_images = {"images": [], "dataset": data["dataset"]}
     new_data = {"images": [], "dataset": data["dataset"]}
 
@@ -92,11 +92,11 @@ def separate_rsicd_test_images(annotations_file: str, test_output_file: str = "d
             new_data["images"].append(img)
 
     # overwrite existing dataset
-    with open(annotations_file, "w") as json_file:
-        json.dump(new_data, json_file)
+    with open(annotations_file, "wb") as json_file:
+        json_file.write(orjson.dumps(new_data))
 
-    with open(test_output_file, "w") as json_file:
-        json.dump(test_images, json_file)
+    with open(test_output_file, "wb") as json_file:
+        json_file.write(orjson.dumps(test_images))
 
 
 def separate_nwpu_test_images(annotations_file: str, test_output_file: str = "dataset_nwpu_test.json"):
@@ -108,8 +108,8 @@ def separate_nwpu_test_images(annotations_file: str, test_output_file: str = "da
             test_output_file (str): Name of the output JSON file for test images.
     """
     data = []
-    with open(annotations_file, encoding="utf8") as json_file:
-        data = json.load(json_file)
+    with open(annotations_file, "rb") as json_file:
+        data = orjson.loads(json_file.read())
 
     train_data = {"images": [], "dataset": "NWPU-Captions"}
     test_data = {"images": [], "dataset": "NWPU-Captions"}
@@ -138,11 +138,11 @@ def separate_nwpu_test_images(annotations_file: str, test_output_file: str = "da
                 train_data["images"].append(row)
 
         # overwrite existing dataset
-    with open(annotations_file, "w") as json_file:
-        json.dump(train_data, json_file)
+    with open(annotations_file, "wb") as json_file:
+        json_file.write(orjson.dumps(train_data))
 
-    with open(test_output_file, "w") as json_file:
-        json.dump(test_data, json_file)
+    with open(test_output_file, "wb") as json_file:
+        json_file.write(orjson.dumps(test_data))
 
 
 def enable_matmul_precision(precision: str = "high"):
@@ -165,14 +165,15 @@ def load_model_checkpoint(model_class, checkpoint_path: str):
         if os.path.exists(checkpoint_path):
             model = model_class.load_from_checkpoint(checkpoint_path, strict=False)
 
-            return model.to(torch.device('cuda')) if torch.cuda.is_available() and model.device.type == "cpu" else model
+            return _model_to_cuda(model)
         else:
             raise Exception(f"checkpoint file: '{checkpoint_path}' does not exist.")
     except FileNotFoundError:
         # Since Lightning saves the checkpoint with the current OS file separator, in case of OS switching,
         # if the checkpoint being loaded was instantiated with a valid "checkpoint_path", the FileNotFoundError
         # exception will be raised
-        ckpt = torch.load(checkpoint_path)
+        # memory-map the checkpoint instead of reading every tensor in a freshly allocated CPU buffer
+        ckpt = torch.load(checkpoint_path, map_location="cpu", mmap=True)
 
         # instantiate model to remain coherent with the checkpoint
         # ignoring the "checkpoint" arguments since they are causing the issue
@@ -182,7 +183,14 @@ def load_model_checkpoint(model_class, checkpoint_path: str):
         # load state dict
         model.load_state_dict(ckpt["state_dict"])
 
-        return model.to(torch.device('cuda')) if torch.cuda.is_available() and model.device.type == "cpu" else model
+        return _model_to_cuda(model)
+
+
+def _model_to_cuda(model):
+    """
+    Move a model loaded on CPU to GPU, if available.
+    """
+    return model.to(torch.device('cuda')) if torch.cuda.is_available() and model.device.type == "cpu" else model
 
 
 class ListWrapper(list):